@@ -23,7 +23,7 @@ import AFQ.registration as reg
 import AFQ.utils.models as ut
 import AFQ.utils.volume as auv
 import AFQ.data as afd
-from AFQ.utils.parallel import parfor
+from AFQ.utils.parallel import parfor, cleanup_loky
 
 __all__ = ["Segmentation", "clean_bundle", "clean_by_endpoints"]
 
@@ -98,9 +98,11 @@ class Segmentation:
             Default: False
         parallel_segmentation : dict or AFQ.api.BundleDict
             How to parallelize segmentation across processes when performing
-            waypoint ROI segmentation. Set to {"engine": "serial"} to not
-            perform parallelization. See ``AFQ.utils.parallel.pafor`` for
-            details.
+            waypoint ROI segmentation. The same settings are used to clean
+            the bundles in parallel, one bundle per job, after
+            segmentation. Set to {"engine": "serial"} to not perform
+            parallelization in either step. See
+            ``AFQ.utils.parallel.parfor`` for details.
             Default: {"n_jobs": -1, "engine": "joblib",
                       "backend": "loky"}
         rm_small_clusters : int
@@ -668,15 +670,7 @@ class Segmentation:
                 (f"{np.sum(streamlines_in_bundles[:, bundle_idx] > 0)} "
                  "streamlines selected with waypoint ROIs"))
 
-        # see https://github.com/joblib/joblib/issues/945
-        if (
-                self.parallel_segmentation["engine"] != "serial"
-                and "backend" in self.parallel_segmentation
-                and self.parallel_segmentation["backend"] == "loky"):
-            from joblib.externals.loky import get_reusable_executor
-            self.logger.info("Cleaning up Loky...")
-            get_reusable_executor().shutdown(wait=True)
-            self.logger.info("Loky Cleaned up")
+        cleanup_loky(self.parallel_segmentation, logger=self.logger)
 
         # Eliminate any fibers not selected using the waypoint ROIs:
         possible_fibers = np.sum(streamlines_in_bundles, -1) > 0
@@ -3,14 +3,16 @@ import os.path as op
 import os
 import numpy as np
 import logging
+import functools
 
 import pimms
 from AFQ.tasks.decorators import as_file
-from AFQ.tasks.utils import get_fname, with_name
+from AFQ.tasks.utils import get_fname, with_name, get_img_data
 import AFQ.data as afd
 import AFQ.utils.volume as auv
 from AFQ.definitions.mapping import SynMap
 from AFQ.definitions.utils import Definition
+from AFQ.utils.parallel import parfor
 
 from dipy.io.streamline import load_tractogram
 from dipy.io.stateful_tractogram import Space
@@ -26,8 +28,10 @@ def export_registered_b0(subses_dict, data_imap, mapping):
     full path to a nifti file containing
     b0 transformed to template space
     """
-    mean_b0 = nib.load(data_imap["b0_file"]).get_fdata()
-    warped_b0 = mapping.transform(mean_b0)
+    mean_b0 = get_img_data(data_imap["b0_file"])
+    # Not all mappings preserve the input dtype, so make sure
+    # that the image is saved as float32
+    warped_b0 = mapping.transform(mean_b0).astype(np.float32, copy=False)
     warped_b0 = nib.Nifti1Image(warped_b0, data_imap["reg_template"].affine)
     return warped_b0, dict(b0InSubject=data_imap["b0_file"])
 
@@ -40,13 +44,15 @@ def template_xform(subses_dict, dwi_affine, mapping, data_imap):
     registration template transformed to subject space
     """
     template_xform = mapping.transform_inverse(
-        data_imap["reg_template"].get_fdata())
+        get_img_data(data_imap["reg_template"])).astype(
+            np.float32, copy=False)
     template_xform = nib.Nifti1Image(template_xform, dwi_affine)
     return template_xform, dict()
 
 
 @pimms.calc("rois_file")
-def export_rois(subses_dict, data_imap, mapping, dwi_affine):
+def export_rois(subses_dict, data_imap, mapping, dwi_affine,
+                segmentation_params):
     """
     dictionary of full paths to Nifti1Image files of ROIs
     transformed to subject space
@@ -55,6 +61,7 @@ def export_rois(subses_dict, data_imap, mapping, dwi_affine):
     rois_dir = op.join(subses_dict['results_dir'], 'ROIs')
     os.makedirs(rois_dir, exist_ok=True)
     roi_files = {}
+    to_export = []
     for bundle in bundle_dict:
         roi_files[bundle] = []
         for ii, roi in enumerate(bundle_dict[bundle]['ROIs']):
@@ -70,24 +77,43 @@ def export_rois(subses_dict, data_imap, mapping, dwi_affine):
 
             fname = op.join(rois_dir, fname[1])
             if not op.exists(fname):
-                warped_roi = auv.transform_inverse_roi(
-                    roi,
-                    mapping,
-                    bundle_name=bundle)
-
-                # Cast to float32, so that it can be read in by MI-Brain:
-                logger.info(f"Saving {fname}")
-                nib.save(
-                    nib.Nifti1Image(
-                        warped_roi.astype(np.float32),
-                        dwi_affine), fname)
-                meta = dict()
-                meta_fname = fname.split('.')[0] + '.json'
-                afd.write_json(meta_fname, meta)
+                to_export.append((roi, bundle, fname))
             roi_files[bundle].append(fname)
+
+    if len(to_export) == 0:
+        return {'rois_file': roi_files}
+
+    # Each ROI is warped and written independently. Only dipy's warping
+    # and zlib's compression release the GIL; patch_up_roi holds it, so
+    # threads overlap those parts of different ROIs, not the whole export
+    parallel_params = segmentation_params["parallel_segmentation"]
+    parfor(
+        _export_roi, to_export,
+        n_jobs=parallel_params.get("n_jobs", -1),
+        engine=parallel_params.get("engine", "joblib"),
+        backend="threading",
+        func_args=[mapping, dwi_affine])
     return {'rois_file': roi_files}
 
 
+def _export_roi(roi_info, mapping, dwi_affine):
+    roi, bundle, fname = roi_info
+    warped_roi = auv.transform_inverse_roi(
+        roi,
+        mapping,
+        bundle_name=bundle)
+
+    # Cast to float32, so that it can be read in by MI-Brain:
+    logger.info(f"Saving {fname}")
+    nib.save(
+        nib.Nifti1Image(
+            warped_roi.astype(np.float32),
+            dwi_affine), fname)
+    meta = dict()
+    meta_fname = fname.split('.')[0] + '.json'
+    afd.write_json(meta_fname, meta)
+
+
 @pimms.calc("mapping")
 def mapping(subses_dict, reg_subject, data_imap, bids_info,
             mapping_definition=None):
@@ -164,13 +190,19 @@ def sls_mapping(subses_dict, reg_subject, data_imap, bids_info,
         'whole_brain_MNI.trk')
     if not op.exists(atlas_fname):
         afd.fetch_hcp_atlas_16_bundles()
-    hcp_atlas = load_tractogram(
-        atlas_fname,
-        'same', bbox_valid_check=False)
     return mapping_definition.get_for_subses(
         subses_dict, bids_info, reg_subject, reg_template,
         subject_sls=tg.streamlines,
-        template_sls=hcp_atlas.streamlines)
+        template_sls=_load_atlas_sls(atlas_fname))
+
+
+# The atlas is the same for every subject, so only read it once
+# per process. Callers must not modify the returned streamlines.
+@functools.lru_cache(maxsize=1)
+def _load_atlas_sls(atlas_fname):
+    return load_tractogram(
+        atlas_fname,
+        'same', bbox_valid_check=False).streamlines
 
 
 @pimms.calc("reg_subject")
@@ -219,9 +251,9 @@ def get_reg_subject(data_imap, bids_info, subses_dict, dwi_affine,
         if reg_subject_spec in filename_dict:
             reg_subject_spec = filename_dict[reg_subject_spec]
     img = nib.load(reg_subject_spec)
-    bm = bm.get_fdata().astype(bool)
-    masked_data = img.get_fdata()
-    masked_data[~bm] = 0
+    masked_data = get_img_data(img)
+    # zero out everything outside the brain mask, in place
+    np.copyto(masked_data, 0, where=(get_img_data(bm) == 0))
     img = nib.Nifti1Image(masked_data, img.affine)
     return img
 
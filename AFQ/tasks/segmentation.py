@@ -10,22 +10,25 @@ import logging
 import pimms
 
 from AFQ.tasks.decorators import as_file
-from AFQ.tasks.utils import get_fname, with_name
+from AFQ.tasks.utils import get_fname, with_name, get_img_data
 import AFQ.segmentation as seg
 import AFQ.utils.streamlines as aus
 from AFQ.tasks.utils import get_default_args
+from AFQ.utils.parallel import parfor, cleanup_loky
 import AFQ.data as afd
 import AFQ.api.bundle_dict as abd
 
 from dipy.io.streamline import load_tractogram, save_tractogram
 from dipy.io.stateful_tractogram import StatefulTractogram, Space
-import dipy.tracking.utils as dtu
-from dipy.stats.analysis import afq_profile, gaussian_weights
+from dipy.stats.analysis import gaussian_weights
 from dipy.tracking.streamline import set_number_of_points, values_from_volume
 
 
 logger = logging.getLogger('AFQ.api.seg')
 
+# This only depends on a function signature, so only inspect it once
+_CLEAN_DEFAULTS = get_default_args(seg.clean_bundle)
+
 
 @pimms.calc("bundles_file")
 @as_file('_tractography.trk', include_track=True, include_seg=True)
@@ -95,6 +98,9 @@ def clean_bundles(subses_dict, bundles_file, data_imap,
     streamlines, cleaned using the Mahalanobis distance, and labeled by
     bundle
 
+    Bundles are cleaned in parallel, as set by the
+    ``parallel_segmentation`` entry of `segmentation_params`.
+
     Parameters
     ----------
     clean_params: dict, optional
@@ -103,7 +109,7 @@ def clean_bundles(subses_dict, bundles_file, data_imap,
         function.
     """
     bundle_dict = data_imap["bundle_dict"]
-    default_clean_params = get_default_args(seg.clean_bundle)
+    default_clean_params = dict(_CLEAN_DEFAULTS)
     if clean_params is not None:
         for k in clean_params:
             default_clean_params[k] = clean_params[k]
@@ -114,44 +120,42 @@ def clean_bundles(subses_dict, bundles_file, data_imap,
         bundles_file,
         img,
         Space.VOX)
-    img = nib.load(subses_dict['dwi_file'])
 
     start_time = time()
-    tgram = nib.streamlines.Tractogram([], {'bundle': []})
+    cleaned_bundles = {}
     if clean_params['return_idx']:
         return_idx = {}
-
-    for b in bundle_dict.keys():
-        if b != "whole_brain":
-            idx = np.where(
-                sft.data_per_streamline['bundle'] == bundle_dict[b]['uid'])[0]
-            this_tg = StatefulTractogram(
-                sft.streamlines[idx],
-                img,
-                Space.VOX)
-            this_tg = seg.clean_bundle(this_tg, **clean_params)
-            if clean_params['return_idx']:
-                this_tg, this_idx = this_tg
-                idx_file = bundles_file.split('.')[0] + '.json'
-                with open(idx_file) as ff:
-                    bundle_idx = json.load(ff)["idx"][b]
-                return_idx[b] = np.array(
-                    bundle_idx)[this_idx].tolist()
-            this_tgram = nib.streamlines.Tractogram(
-                this_tg.streamlines,
-                data_per_streamline={
-                    'bundle': (
-                        len(this_tg) * [bundle_dict[b]['uid']])},
-                    affine_to_rasmm=img.affine)
-            tgram = aus.add_bundles(tgram, this_tgram)
-
-    sft = StatefulTractogram(
-        tgram.streamlines,
-        sft,
-        Space.VOX,
-        data_per_streamline=tgram.data_per_streamline)
-
-    seg_args = get_default_args(seg.clean_bundle)
+        idx_file = bundles_file.split('.')[0] + '.json'
+        with open(idx_file) as ff:
+            bundles_idx = json.load(ff)["idx"]
+
+    # Bundles are cleaned independently of each other,
+    # so clean them in parallel
+    uid_to_idx = aus.bundle_idx_by_uid(sft.data_per_streamline['bundle'])
+    bundles = [b for b in bundle_dict.keys() if b != "whole_brain"]
+    bundle_sls = [
+        sft.streamlines[uid_to_idx.get(
+            bundle_dict[b]['uid'], np.array([], dtype=int))]
+        for b in bundles]
+    parallel_params = segmentation_params["parallel_segmentation"]
+    results = parfor(
+        _clean_bundle_idx, bundle_sls,
+        func_args=[img, clean_params],
+        **parallel_params)
+    cleanup_loky(parallel_params)
+
+    for b, this_sl, this_idx in zip(bundles, bundle_sls, results):
+        cleaned_bundles[b] = StatefulTractogram(
+            this_sl[this_idx],
+            img,
+            Space.VOX)
+        if clean_params['return_idx']:
+            return_idx[b] = np.array(
+                bundles_idx[b])[this_idx].tolist()
+
+    sft = aus.bundles_to_tgram(cleaned_bundles, bundle_dict, img)
+
+    seg_args = dict(_CLEAN_DEFAULTS)
     for k in seg_args:
         if callable(seg_args[k]):
             seg_args[k] = seg_args[k].__name__
@@ -167,6 +171,18 @@ def clean_bundles(subses_dict, bundles_file, data_imap,
     return sft, meta
 
 
+# Returns the indices of the streamlines that are kept after cleaning,
+# which are cheaper to send back from worker processes than streamlines
+def _clean_bundle_idx(streamlines, img, clean_params):
+    this_tg = StatefulTractogram(
+        streamlines,
+        img,
+        Space.VOX)
+    clean_params = {**clean_params, "return_idx": True}
+    _, this_idx = seg.clean_bundle(this_tg, **clean_params)
+    return this_idx
+
+
 @pimms.calc("indiv_bundles")
 def export_bundles(subses_dict, clean_bundles_file, bundles_file,
                    data_imap, tracking_params,
@@ -190,37 +206,45 @@ def export_bundles(subses_dict, clean_bundles_file, bundles_file,
                 resample_to=reg_template)
 
     img = nib.load(subses_dict['dwi_file'])
-    for this_bundles_file, folder in zip([clean_bundles_file, bundles_file],
-                                         ['clean_bundles', 'bundles']):
+    bundles = [b for b in bundle_dict if b != "whole_brain"]
+    for this_bundles_file, folder in zip(
+            [clean_bundles_file, bundles_file],
+            ['clean_bundles', 'bundles']):
         bundles_dir = op.join(subses_dict['results_dir'], folder)
         os.makedirs(bundles_dir, exist_ok=True)
+        fnames = {}
+        for bundle in bundles:
+            fname = op.split(
+                get_fname(
+                    subses_dict,
+                    f'-{bundle}'
+                    f'_tractography.trk',
+                    tracking_params=tracking_params,
+                    segmentation_params=segmentation_params))
+            fnames[bundle] = op.join(bundles_dir, fname[1])
+        # Don't load the tractogram if there is nothing to write
+        if all(op.exists(fname) for fname in fnames.values()):
+            continue
+
         trk = nib.streamlines.load(this_bundles_file)
         tg = trk.tractogram
         streamlines = tg.streamlines
-        for bundle in bundle_dict:
-            if bundle != "whole_brain":
-                uid = bundle_dict[bundle]['uid']
-                idx = np.where(tg.data_per_streamline['bundle'] == uid)[0]
-                this_sl = dtu.transform_tracking_output(
-                    streamlines[idx],
-                    np.linalg.inv(img.affine))
-
-                this_tgm = StatefulTractogram(
-                    this_sl, img, Space.VOX)
-                fname = op.split(
-                    get_fname(
-                        subses_dict,
-                        f'-{bundle}'
-                        f'_tractography.trk',
-                        tracking_params=tracking_params,
-                        segmentation_params=segmentation_params))
-                fname = op.join(bundles_dir, fname[1])
-                logger.info(f"Saving {fname}")
-                save_tractogram(
-                    this_tgm, fname, bbox_valid_check=False)
-                meta = dict(source=this_bundles_file)
-                meta_fname = fname.split('.')[0] + '.json'
-                afd.write_json(meta_fname, meta)
+        uid_to_idx = aus.bundle_idx_by_uid(
+            tg.data_per_streamline['bundle'])
+        for bundle in bundles:
+            uid = bundle_dict[bundle]['uid']
+            idx = uid_to_idx.get(uid, np.array([], dtype=int))
+            # nibabel loads streamlines in RASMM, which is also
+            # the space they are saved in, so keep them there
+            this_tgm = StatefulTractogram(
+                streamlines[idx], img, Space.RASMM)
+            fname = fnames[bundle]
+            logger.info(f"Saving {fname}")
+            save_tractogram(
+                this_tgm, fname, bbox_valid_check=False)
+            meta = dict(source=this_bundles_file)
+            meta_fname = fname.split('.')[0] + '.json'
+            afd.write_json(meta_fname, meta)
     return True
 
 
@@ -233,7 +257,6 @@ def export_sl_counts(subses_dict, data_imap,
     full path to a JSON file containing streamline counts
     """
     bundle_dict = data_imap["bundle_dict"]
-    img = nib.load(subses_dict['dwi_file'])
     sl_counts_clean = []
     sl_counts = []
     bundles = list(bundle_dict.keys())
@@ -243,16 +266,15 @@ def export_sl_counts(subses_dict, data_imap,
     lists = [sl_counts_clean, sl_counts]
 
     for bundles_file, count in zip(bundles_files, lists):
-        tg = load_tractogram(bundles_file, img)
-        bundles = aus.tgram_to_bundles(
-            tg, bundle_dict, img)
+        labels = _bundle_labels(bundles_file)
+        uid_counts = dict(zip(*np.unique(labels, return_counts=True)))
 
         for bundle in bundles:
             if bundle == "whole_brain":
-                count.append(len(tg.streamlines))
+                count.append(len(labels))
             else:
-                count.append(len(
-                    bundles[bundle].streamlines))
+                count.append(uid_counts.get(
+                    bundle_dict[bundle]['uid'], 0))
     counts_df = pd.DataFrame(
         data=dict(
             n_streamlines=sl_counts,
@@ -261,6 +283,14 @@ def export_sl_counts(subses_dict, data_imap,
     return counts_df, dict(sources=bundles_files)
 
 
+def _bundle_labels(fname):
+    # Only the bundle labels are needed for counting, so load lazily
+    # and never build the streamlines themselves
+    trk = nib.streamlines.load(fname, lazy_load=True)
+    return np.asarray(list(
+        trk.tractogram.data_per_streamline['bundle'])).ravel()
+
+
 @pimms.calc("profiles_file")
 @as_file('_profiles.csv', include_track=True, include_seg=True)
 def tract_profiles(subses_dict, clean_bundles_file, data_imap,
@@ -305,50 +335,30 @@ def tract_profiles(subses_dict, clean_bundles_file, data_imap,
             vals.append(k)
     reverse_dict = dict(zip(keys, vals))
 
-    bundle_names = []
-    node_numbers = []
-    profiles = np.empty((len(scalar_dict), 0)).tolist()
-    this_profile = np.zeros((len(scalar_dict), 100))
+    n_nodes = 100
+    if not (profile_weights is None
+            or isinstance(profile_weights, str)
+            or callable(profile_weights)):
+        if not np.allclose(np.sum(profile_weights, 0), np.ones(n_nodes)):
+            raise ValueError(
+                "The sum of weights across streamlines must be equal to 1")
+
+    # Load each scalar once, rather than once per bundle
+    scalar_arrays = [
+        get_img_data(scalar_file) for scalar_file in scalar_dict.values()]
 
     trk = nib.streamlines.load(clean_bundles_file)
-    for b in np.unique(
-            trk.tractogram.data_per_streamline['bundle']):
-        idx = np.where(
-            trk.tractogram.data_per_streamline['bundle'] == b)[0]
-        this_sl = trk.streamlines[idx]
-        bundle_name = reverse_dict[b]
-        for ii, (scalar, scalar_file) in enumerate(scalar_dict.items()):
-            scalar_data = nib.load(scalar_file).get_fdata()
-            if isinstance(profile_weights, str):
-                if profile_weights == "gauss":
-                    this_prof_weights = gaussian_weights(this_sl)
-                elif profile_weights == "median":
-                    # weights bundle to only return the mean
-                    def _median_weight(bundle):
-                        fgarray = set_number_of_points(bundle, 100)
-                        values = np.array(
-                            values_from_volume(
-                                scalar_data,
-                                fgarray,
-                                dwi_affine))
-                        weights = np.zeros(values.shape)
-                        for ii, jj in enumerate(
-                            np.argsort(values, axis=0)[
-                                len(values) // 2, :]):
-                            weights[jj, ii] = 1
-                        return weights
-                    this_prof_weights = _median_weight
-            else:
-                this_prof_weights = profile_weights
-            this_profile[ii] = afq_profile(
-                scalar_data,
-                this_sl,
-                dwi_affine,
-                weights=this_prof_weights)
-            profiles[ii].extend(list(this_profile[ii]))
-        nodes = list(np.arange(this_profile[0].shape[0]))
-        bundle_names.extend([bundle_name] * len(nodes))
-        node_numbers.extend(nodes)
+    uid_to_idx = aus.bundle_idx_by_uid(
+        trk.tractogram.data_per_streamline['bundle'])
+
+    # Each bundle fills n_nodes consecutive rows of the output
+    n_bundles = len(uid_to_idx)
+    bundle_names = np.repeat(
+        [reverse_dict[b] for b in uid_to_idx.keys()], n_nodes)
+    node_numbers = np.tile(np.arange(n_nodes), n_bundles)
+    profiles = _bundle_profiles(
+        scalar_arrays, trk.streamlines, list(uid_to_idx.values()),
+        dwi_affine, profile_weights, n_nodes=n_nodes)
 
     profile_dict = dict()
     profile_dict["tractID"] = bundle_names
@@ -357,12 +367,101 @@ def tract_profiles(subses_dict, clean_bundles_file, data_imap,
         profile_dict[scalar] = profiles[ii]
 
     profile_dframe = pd.DataFrame(profile_dict)
+    if callable(profile_weights):
+        # partials and callable instances do not have a __name__
+        weights_used = getattr(
+            profile_weights, "__name__", repr(profile_weights))
+    elif profile_weights is None or isinstance(profile_weights, str):
+        weights_used = profile_weights
+    else:
+        weights_used = "array"
     meta = dict(source=clean_bundles_file,
-                parameters=get_default_args(afq_profile))
+                parameters=dict(
+                    n_points=n_nodes,
+                    weights=weights_used,
+                    stat="np.average"))
 
     return profile_dframe, meta
 
 
+def _bundle_profiles(scalar_arrays, streamlines, bundle_idx, affine,
+                     profile_weights, n_nodes=100):
+    """
+    Calculate the profiles of several bundles along several scalars,
+    giving the same result as calling afq_profile for each pair of them
+
+    Parameters
+    ----------
+    scalar_arrays : list of 3D arrays
+        The scalar volumes to sample.
+    streamlines : Streamlines
+        All of the streamlines, in the space defined by `affine`.
+    bundle_idx : list of 1D int arrays
+        The indices into `streamlines` of each bundle.
+    affine : array (4, 4)
+        The mapping from voxel coordinates to streamline points.
+    profile_weights : str, 1D array, 2D array, callable or None
+        As in `tract_profiles`, with strings already lower case.
+    n_nodes : int, optional
+        The number of nodes in each profile.
+        Default: 100
+
+    Returns
+    -------
+    array of shape (len(scalar_arrays), len(bundle_idx) * n_nodes)
+    """
+    profiles = np.empty((len(scalar_arrays), len(bundle_idx) * n_nodes))
+    if len(bundle_idx) == 0:
+        return profiles
+
+    # Weights that do not depend on the scalar are computed once per bundle
+    bundle_weights = []
+    for idx in bundle_idx:
+        if isinstance(profile_weights, str):
+            if profile_weights == "gauss":
+                bundle_weights.append(gaussian_weights(
+                    streamlines[idx], n_points=n_nodes))
+            else:
+                # median weights are calculated from the values
+                bundle_weights.append(None)
+        elif callable(profile_weights):
+            bundle_weights.append(profile_weights(streamlines[idx]))
+        else:
+            bundle_weights.append(profile_weights)
+
+    # Resample all streamlines once, so that each scalar is sampled
+    # at the nodes of every bundle in a single call
+    fgarray = set_number_of_points(streamlines, n_nodes)
+    fgarray = fgarray.get_data().reshape((-1, n_nodes, 3))
+    # Move the nodes into voxel space once, instead of once per scalar
+    fgarray = nib.affines.apply_affine(np.linalg.inv(affine), fgarray)
+    for ii, scalar_data in enumerate(scalar_arrays):
+        values = np.asarray(values_from_volume(
+            scalar_data,
+            fgarray,
+            np.eye(4)))
+        for b_idx, idx in enumerate(bundle_idx):
+            this_values = values[idx]
+            if isinstance(profile_weights, str)\
+                    and profile_weights == "median":
+                this_prof_weights = _median_weights(this_values)
+            else:
+                this_prof_weights = bundle_weights[b_idx]
+            profiles[ii, b_idx * n_nodes:(b_idx + 1) * n_nodes] =\
+                np.average(this_values, weights=this_prof_weights, axis=0)
+    return profiles
+
+
+# weights bundle to only return the median
+def _median_weights(values):
+    # only the median position is needed, so partition instead of sorting
+    k = len(values) // 2
+    median_idx = np.argpartition(values, k, axis=0)[k]
+    weights = np.zeros(values.shape)
+    weights[median_idx, np.arange(values.shape[1])] = 1
+    return weights
+
+
 @pimms.calc("scalar_dict")
 def get_scalar_dict(data_imap, mapping_imap, scalars=["dti_fa", "dti_md"]):
     """
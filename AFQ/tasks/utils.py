@@ -1,7 +1,10 @@
 import os.path as op
 import inspect
 
-__all__ = ["get_fname", "with_name"]
+import numpy as np
+import nibabel as nib
+
+__all__ = ["get_fname", "with_name", "get_img_data"]
 
 
 def get_fname(subses_dict, suffix,
@@ -23,6 +26,15 @@ def get_fname(subses_dict, suffix,
     return fname + suffix
 
 
+# Load image data as float32, without keeping a cached copy on the image.
+# keep_file_open lets nibabel use indexed_gzip for .nii.gz files,
+# if it is installed
+def get_img_data(img):
+    if isinstance(img, str):
+        img = nib.load(img, keep_file_open=True)
+    return img.get_fdata(dtype=np.float32, caching='unchanged')
+
+
 # Turn list of tasks into dictionary with names for each task
 def with_name(task_list):
     task_dict = {}
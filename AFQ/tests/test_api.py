@@ -1,9 +1,14 @@
 import tempfile
+import atexit
+import functools
+import gzip
+import json
 import os
 import os.path as op
 import shutil
 import subprocess
 import gc
+from io import BytesIO
 
 import toml
 
@@ -17,6 +22,8 @@ from pandas.testing import assert_series_equal
 import nibabel as nib
 import nibabel.tmpdirs as nbtmp
 
+from bids.layout import BIDSLayout
+
 import dipy.tracking.utils as dtu
 import dipy.tracking.streamline as dts
 import dipy.data as dpd
@@ -42,56 +49,169 @@ def touch(fname, times=None):
         os.utime(fname, times)
 
 
-def get_temp_hardi():
-    tmpdir = nbtmp.InTemporaryDirectory()
-    afd.organize_stanford_data(path=tmpdir.name)
-    bids_path = op.join(tmpdir.name, 'stanford_hardi')
+@pytest.fixture(scope="session")
+def hardi_master(tmp_path_factory):
+    # Stage the Stanford HARDI data once per session
+    root = tmp_path_factory.mktemp("hardi_master")
+    afd.organize_stanford_data(path=str(root))
+    return root
+
+
+def copy_hardi(hardi_master, tmp_path):
+    # Hardlink the staged inputs, so each test gets its own tree cheaply
+    bids_path = op.join(tmp_path, 'stanford_hardi')
+    shutil.copytree(
+        op.join(hardi_master, 'stanford_hardi'), bids_path,
+        copy_function=os.link)
 
     sub_path = op.join(
-        tmpdir.name,
-        'stanford_hardi',
+        bids_path,
         'derivatives',
         'vistasoft',
         'sub-01',
         'ses-01',
         'dwi')
 
-    return tmpdir, bids_path, sub_path
+    return bids_path, sub_path
 
 
-def create_dummy_data(dmriprep_dir, subject, session=None):
-    aff = np.eye(4)
-    data = np.ones((10, 10, 10, 6))
-    bvecs = np.vstack([np.eye(3), np.eye(3)])
-    bvecs[0] = 0
-    bvals = np.ones(6) * 1000.
-    bvals[0] = 0
+@pytest.fixture
+def hardi(hardi_master, tmp_path):
+    bids_path, sub_path = copy_hardi(hardi_master, tmp_path)
+    return str(tmp_path), bids_path, sub_path
+
+
+@pytest.fixture(scope="session")
+def hardi_layout(hardi_master):
+    # Index the staged HARDI data only once
+    return BIDSLayout(
+        op.join(hardi_master, 'stanford_hardi'), derivatives=True)
+
+
+@pytest.fixture
+def shared_hardi(monkeypatch, hardi_master, hardi_layout):
+    # For tests that only read the staged HARDI data, and write their
+    # outputs to their own output_dir. Returns the bids_path to use
+    bids_path = op.join(hardi_master, 'stanford_hardi')
+
+    def get_layout(root, *args, **kwargs):
+        assert op.samefile(root, bids_path)
+        return hardi_layout
+
+    monkeypatch.setattr("AFQ.api.group.BIDSLayout", get_layout)
+    return bids_path
+
+
+@pytest.fixture(scope="session")
+def cfin_master(tmp_path_factory):
+    # Stage the CFIN data once per session
+    root = tmp_path_factory.mktemp("cfin_master")
+    afd.organize_cfin_data(path=str(root))
+    return root
+
+
+@pytest.fixture
+def cfin(cfin_master, tmp_path):
+    bids_path = op.join(tmp_path, 'cfin_multib')
+    shutil.copytree(
+        op.join(cfin_master, 'cfin_multib'), bids_path,
+        copy_function=os.link)
+    return bids_path
+
 
+def _link_or_rename(src, dst):
+    # Hardlink fetched data into place where possible, which needs no
+    # copy and leaves the fetched file for later tests
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.move(src, dst)
+
+
+def _mk_afq(bids_path, **kwargs):
+    # All of the test datasets only contain the one subject
+    kwargs.setdefault("participant_labels", ["01"])
+    return GroupAFQ(bids_path, **kwargs)
+
+
+@functools.lru_cache(maxsize=1)
+def tmpdir_root():
+    # Put small temporary BIDS trees in memory when tmpfs is available,
+    # all under one folder that is removed when the test process exits
+    shm = "/dev/shm"
+    if op.isdir(shm) and os.access(shm, os.W_OK):
+        parent = shm
+    else:
+        parent = None
+    root = tempfile.mkdtemp(prefix="pyafq_test_", dir=parent)
+    atexit.register(shutil.rmtree, root, ignore_errors=True)
+    return root
+
+
+# The dummy data are the same for every subject and session,
+# so serialize them only once. The b-values and b-vectors are written
+# out as np.savetxt would write them
+_ZERO = b"0.000000000000000000e+00"
+_ONE = b"1.000000000000000000e+00"
+_DUMMY_BVAL_BYTES = (
+    _ZERO + b"\n" + b"1.000000000000000000e+03\n" * 5)
+_DUMMY_BVEC_BYTES = b"".join(
+    b" ".join(row) + b"\n" for row in [
+        (_ZERO, _ZERO, _ZERO),
+        (_ZERO, _ONE, _ZERO),
+        (_ZERO, _ZERO, _ONE),
+        (_ONE, _ZERO, _ZERO),
+        (_ZERO, _ONE, _ZERO),
+        (_ZERO, _ZERO, _ONE)])
+
+
+@functools.lru_cache(maxsize=1)
+def dummy_nii_bytes():
+    # The same image is used for the dwi, T1w and seg files. Compress
+    # with a fixed mtime, so that every copy is byte-for-byte identical
+    img = nib.Nifti1Image(
+        np.ones((10, 10, 10, 6), dtype=np.uint8), np.eye(4))
+    bio = BytesIO()
+    with gzip.GzipFile(fileobj=bio, mode='wb', mtime=0) as gz:
+        gz.write(img.to_bytes())
+    return bio.getvalue()
+
+
+# These are the descriptions afd.to_bids_description would write
+_DUMMY_DERIV_DESCRIPTION_BYTES = json.dumps({
+    "Name": "Dummy",
+    "PipelineDescription": {"Name": "synthetic"},
+    "BIDSVersion": "1.4.0"}).encode()
+
+
+@functools.lru_cache(maxsize=None)
+def dummy_description_bytes(subjects, sessions=None):
+    description = {"Name": "Dummy", "Subjects": list(subjects)}
+    if sessions is not None:
+        description["Sessions"] = list(sessions)
+    description["BIDSVersion"] = "1.4.0"
+    return json.dumps(description).encode()
+
+
+def write_bytes(fname, blob):
+    with open(fname, 'wb') as ff:
+        ff.write(blob)
+
+
+def create_dummy_data(dmriprep_dir, subject, session=None):
     if session is None:
-        data_dir = subject
+        data_dir = op.join(dmriprep_dir, subject)
     else:
-        data_dir = op.join(subject, session)
+        data_dir = op.join(dmriprep_dir, subject, session)
 
-    np.savetxt(
-        op.join(
-            dmriprep_dir, data_dir, 'dwi', 'dwi.bval'),
-        bvals)
-    np.savetxt(
-        op.join(
-            dmriprep_dir, data_dir, 'dwi', 'dwi.bvec'),
-        bvecs)
-    nib.save(
-        nib.Nifti1Image(data, aff),
-        op.join(
-            dmriprep_dir, data_dir, 'dwi', 'dwi.nii.gz'))
-    nib.save(
-        nib.Nifti1Image(data, aff),
-        op.join(
-            dmriprep_dir, data_dir, 'anat', 'T1w.nii.gz'))
-    nib.save(
-        nib.Nifti1Image(data, aff),
-        op.join(
-            dmriprep_dir, data_dir, 'anat', 'seg.nii.gz'))
+    write_bytes(op.join(data_dir, 'dwi', 'dwi.bval'), _DUMMY_BVAL_BYTES)
+    write_bytes(op.join(data_dir, 'dwi', 'dwi.bvec'), _DUMMY_BVEC_BYTES)
+    nii_bytes = dummy_nii_bytes()
+    for fname in [
+            op.join(data_dir, 'dwi', 'dwi.nii.gz'),
+            op.join(data_dir, 'anat', 'T1w.nii.gz'),
+            op.join(data_dir, 'anat', 'seg.nii.gz')]:
+        write_bytes(fname, nii_bytes)
 
 
 def create_dummy_bids_path(n_subjects, n_sessions, share_sessions=True):
@@ -103,82 +223,65 @@ def create_dummy_bids_path(n_subjects, n_sessions, share_sessions=True):
         # create data for n_sessions for each subject
         if share_sessions:
             sessions = ['ses-0%s' % (d + 1) for d in range(n_sessions)]
-
-            bids_dir = tempfile.mkdtemp()
-
-            afd.to_bids_description(
-                bids_dir,
-                **{"Name": "Dummy",
-                   "Subjects": subjects,
-                   "Sessions": sessions})
-
-            dmriprep_dir = op.join(bids_dir, "derivatives", "dmriprep")
-            os.makedirs(dmriprep_dir)
-            afd.to_bids_description(
-                dmriprep_dir,
-                **{"Name": "Dummy",
-                   "PipelineDescription": {"Name": "synthetic"}})
-
-            for subject in subjects:
-                for session in sessions:
-                    for modality in ['anat', 'dwi']:
-                        os.makedirs(
-                            op.join(dmriprep_dir, subject, session, modality))
-                    # Make some dummy data:
-                    create_dummy_data(dmriprep_dir, subject, session)
+            subses = [
+                (subject, session)
+                for subject in subjects for session in sessions]
         else:
             # create different sessions for each subject
             sessions = ['ses-0%s' % (d + 1) for d in range(n_subjects)]
-
-            bids_dir = tempfile.mkdtemp()
-
-            afd.to_bids_description(
-                bids_dir,
-                **{"Name": "Dummy",
-                   "Subjects": subjects,
-                   "Sessions": sessions})
-
-            dmriprep_dir = op.join(bids_dir, "derivatives", "dmriprep")
-            os.makedirs(dmriprep_dir)
-            afd.to_bids_description(
-                dmriprep_dir,
-                **{"Name": "Dummy",
-                   "PipelineDescription": {"Name": "synthetic"}})
-
-            for d in range(n_subjects):
-                subject = subjects[d]
-                session = sessions[d]
-                for modality in ['anat', 'dwi']:
-                    os.makedirs(
-                        op.join(dmriprep_dir, subject, session, modality))
-                # Make some dummy data:
-                create_dummy_data(dmriprep_dir, subject, session)
+            subses = list(zip(subjects, sessions))
     else:
         # Don't create session folders at all:
-        bids_dir = tempfile.mkdtemp()
+        sessions = None
+        subses = [(subject, None) for subject in subjects]
+
+    bids_dir = tempfile.mkdtemp(dir=tmpdir_root())
+    write_bytes(
+        op.join(bids_dir, 'dataset_description.json'),
+        dummy_description_bytes(
+            tuple(subjects), sessions and tuple(sessions)))
+
+    dmriprep_dir = op.join(bids_dir, "derivatives", "dmriprep")
+
+    # Collect every folder first, so that each is only made once
+    data_dirs = set()
+    for subject, session in subses:
+        for modality in ['anat', 'dwi']:
+            if session is None:
+                data_dirs.add(op.join(dmriprep_dir, subject, modality))
+            else:
+                data_dirs.add(
+                    op.join(dmriprep_dir, subject, session, modality))
+    for data_dir in data_dirs:
+        os.makedirs(data_dir, exist_ok=True)
+
+    write_bytes(
+        op.join(dmriprep_dir, 'dataset_description.json'),
+        _DUMMY_DERIV_DESCRIPTION_BYTES)
 
-        afd.to_bids_description(
-            bids_dir,
-            **{"Name": "Dummy", "Subjects": subjects})
+    for subject, session in subses:
+        # Make some dummy data:
+        create_dummy_data(dmriprep_dir, subject, session)
+
+    return bids_dir
 
-        dmriprep_dir = op.join(bids_dir, "derivatives", "dmriprep")
-        os.makedirs(dmriprep_dir)
-        afd.to_bids_description(
-            dmriprep_dir,
-            **{"Name": "Dummy",
-               "PipelineDescription": {"Name": "synthetic"}})
 
-        for subject in subjects:
-            for modality in ['anat', 'dwi']:
-                os.makedirs(op.join(dmriprep_dir, subject, modality))
-            # Make some dummy data:
-            create_dummy_data(dmriprep_dir, subject)
+@functools.lru_cache(maxsize=None)
+def _cached_dummy_bids_path(n_subjects, n_sessions, share_sessions):
+    return create_dummy_bids_path(n_subjects, n_sessions, share_sessions)
 
+
+def copy_dummy_bids_path(n_subjects, n_sessions, share_sessions=True):
+    # Build each dummy dataset once, and hand out hardlinked copies of it
+    bids_dir = op.join(tempfile.mkdtemp(dir=tmpdir_root()), 'bids')
+    shutil.copytree(
+        _cached_dummy_bids_path(n_subjects, n_sessions, share_sessions),
+        bids_dir, copy_function=os.link)
     return bids_dir
 
 
 def test_AFQ_missing_files():
-    tmpdir = nbtmp.InTemporaryDirectory()
+    tmpdir = nbtmp.InTemporaryDirectory(dir=tmpdir_root())
     bids_path = tmpdir.name
 
     with pytest.raises(
@@ -230,18 +333,18 @@ def test_AFQ_missing_files():
 
 
 @pytest.mark.nightly_custom
-def test_AFQ_custom_tract():
+def test_AFQ_custom_tract(hardi):
     """
     Test whether AFQ can use tractography from
     import_tract
     """
-    _, bids_path, sub_path = get_temp_hardi()
+    _, bids_path, sub_path = hardi
     afd.fetch_stanford_hardi_tractography()
 
     bundle_names = ["SLF", "ARC", "CST", "FP"]
 
     # move subsampled tractography into bids folder
-    os.rename(
+    _link_or_rename(
         op.join(
             op.expanduser('~'),
             'AFQ_data',
@@ -281,101 +384,101 @@ def test_AFQ_no_derivs():
 
 @pytest.mark.nightly_custom
 @xvfb_it
-def test_AFQ_fury():
-    _, bids_path, _ = get_temp_hardi()
+def test_AFQ_fury(hardi):
+    _, bids_path, _ = hardi
 
-    myafq = GroupAFQ(
+    myafq = _mk_afq(
         bids_path=bids_path,
         preproc_pipeline='vistasoft',
         viz_backend_spec="fury")
     myafq.all_bundles_figure
 
 
-def test_AFQ_init():
+@pytest.mark.parametrize(
+    "n_sessions,participant_labels",
+    [(1, None), (2, None), (3, None), (3, ["01"]), (3, ["04"])])
+def test_AFQ_init(n_sessions, participant_labels):
     """
     Test the initialization of the AFQ object
     """
-    for n_sessions in [1, 2, 3]:
-        if n_sessions == 3:
-            # we only need to test all of these once
-            participant_labels_to_test = [None, ["01"], ["04"]]
-        else:
-            participant_labels_to_test = [None]
-        for participant_labels in participant_labels_to_test:
-            if participant_labels is None:
-                n_subjects = 3
-            else:
-                n_subjects = 1
-            bids_path = create_dummy_bids_path(
-                n_subjects, n_sessions,
-                (n_subjects != n_sessions))
-
-            if participant_labels is not None and\
-                    participant_labels[0] == "04":
-                with pytest.raises(
-                    ValueError,
-                    match="No subjects specified in `participant_labels` "
-                    + " found in BIDS derivatives folders."
-                        + " See above warnings."):
-                    my_afq = GroupAFQ(
-                        bids_path,
-                        preproc_pipeline="synthetic",
-                        participant_labels=participant_labels)
+    if participant_labels is None:
+        n_subjects = 3
+    else:
+        n_subjects = 1
+    bids_path = copy_dummy_bids_path(
+        n_subjects, n_sessions,
+        (n_subjects != n_sessions))
+
+    if participant_labels is not None and\
+            participant_labels[0] == "04":
+        with pytest.raises(
+            ValueError,
+            match="No subjects specified in `participant_labels` "
+            + " found in BIDS derivatives folders."
+                + " See above warnings."):
+            my_afq = GroupAFQ(
+                bids_path,
+                preproc_pipeline="synthetic",
+                participant_labels=participant_labels)
+    else:
+        my_afq = GroupAFQ(
+            bids_path,
+            preproc_pipeline="synthetic",
+            participant_labels=participant_labels)
+
+        for subject in range(n_subjects):
+            sub = f"0{subject+1}"
+            if n_subjects == n_sessions:
+                npt.assert_equal(
+                    len(my_afq.wf_dict[sub][sub]),
+                    26)
             else:
-                my_afq = GroupAFQ(
-                    bids_path,
-                    preproc_pipeline="synthetic",
-                    participant_labels=participant_labels)
-
-                for subject in range(n_subjects):
-                    sub = f"0{subject+1}"
-                    if n_subjects == n_sessions:
-                        npt.assert_equal(
-                            len(my_afq.wf_dict[sub][sub]),
-                            26)
+                for session in range(n_sessions):
+                    if n_sessions == 1:
+                        sess = "None"
                     else:
-                        for session in range(n_sessions):
-                            if n_sessions == 1:
-                                sess = "None"
-                            else:
-                                sess = f"0{session+1}"
-                            npt.assert_equal(
-                                len(my_afq.wf_dict[sub][sess]),
-                                26)
+                        sess = f"0{session+1}"
+                    npt.assert_equal(
+                        len(my_afq.wf_dict[sub][sess]),
+                        26)
 
 
 @pytest.mark.nightly_basic
-def test_AFQ_data():
+def test_AFQ_data(shared_hardi, tmp_path):
     """
     Test if API can run without prealign and with only pre-align
     """
-    _, bids_path, _ = get_temp_hardi()
+    bids_path = shared_hardi
 
-    for mapping in [SynMap(use_prealign=False), AffMap()]:
-        myafq = GroupAFQ(
+    # Give each mapping its own outputs, rather than removing them
+    for ii, mapping in enumerate([SynMap(use_prealign=False), AffMap()]):
+        myafq = _mk_afq(
             bids_path=bids_path,
             preproc_pipeline='vistasoft',
+            output_dir=op.join(tmp_path, f"afq_{ii}"),
             mapping_definition=mapping)
-        npt.assert_equal(nib.load(myafq.b0["01"]).shape,
-                         nib.load(myafq.dwi_file["01"]).shape[:3])
-        npt.assert_equal(nib.load(myafq.b0["01"]).shape,
-                         nib.load(myafq.dti_params["01"]).shape[:3])
+        # Only the headers are needed to compare shapes
+        b0_shape = nib.load(myafq.b0["01"]).header.get_data_shape()
+        npt.assert_equal(
+            b0_shape,
+            nib.load(myafq.dwi_file["01"]).header.get_data_shape()[:3])
+        npt.assert_equal(
+            b0_shape,
+            nib.load(myafq.dti_params["01"]).header.get_data_shape()[:3])
         myafq.rois
-        shutil.rmtree(op.join(
-            bids_path,
-            'derivatives/afq'))
 
 
 @pytest.mark.nightly_anisotropic
-def test_AFQ_anisotropic():
+def test_AFQ_anisotropic(shared_hardi, tmp_path):
     """
     Test if API can run using anisotropic registration
     with a specific selection of b vals
     """
-    _, bids_path, _ = get_temp_hardi()
-    myafq = GroupAFQ(
+    bids_path = shared_hardi
+    myafq = _mk_afq(
         bids_path=bids_path,
         preproc_pipeline='vistasoft',
+        output_dir=op.join(tmp_path, "afq"),
         min_bval=1990,
         max_bval=2010,
         b0_threshold=50,
@@ -385,16 +488,15 @@ def test_AFQ_anisotropic():
     gtab = myafq.gtab["01"]
 
     # check the b0s mask is correct
-    b0s_mask = np.zeros(160, dtype=bool)
-    b0s_mask[0:10] = True
-    npt.assert_equal(gtab.b0s_mask, b0s_mask)
+    b0s_mask = gtab.b0s_mask
+    npt.assert_equal(b0s_mask.shape, (160,))
+    assert b0s_mask[:10].all()
+    assert not b0s_mask[10:].any()
 
     # check that only b values in the b val range passed
-    bvals_in_range = \
-        np.logical_and((gtab.bvals > 1990), (gtab.bvals < 2010))
     bvals_in_range_or_0 = \
-        np.logical_or(bvals_in_range, gtab.b0s_mask)
-    npt.assert_equal(bvals_in_range_or_0, np.ones(160, dtype=bool))
+        ((gtab.bvals > 1990) & (gtab.bvals < 2010)) | b0s_mask
+    assert bvals_in_range_or_0.all()
 
     # check that the apm map was made
     myafq.mapping
@@ -404,8 +506,8 @@ def test_AFQ_anisotropic():
 
 
 @pytest.mark.nightly_slr
-def test_API_type_checking():
-    _, bids_path, _ = get_temp_hardi()
+def test_API_type_checking(hardi):
+    _, bids_path, _ = hardi
     with pytest.raises(
             TypeError,
             match="bids_path must be a string"):
@@ -448,31 +550,32 @@ def test_API_type_checking():
 
 
 @pytest.mark.nightly_slr
-def test_AFQ_slr():
+def test_AFQ_slr(shared_hardi, tmp_path):
     """
     Test if API can run using slr map
     """
-    _, bids_path, _ = get_temp_hardi()
-    myafq = GroupAFQ(
+    bids_path = shared_hardi
+    myafq = _mk_afq(
         bids_path=bids_path,
         preproc_pipeline='vistasoft',
+        output_dir=op.join(tmp_path, "afq"),
         reg_subject_spec='subject_sls',
         reg_template_spec='hcp_atlas',
         mapping_definition=SlrMap())
 
-    tgram = load_tractogram(myafq.clean_bundles["01"], myafq.img["01"])
-    bundles = aus.tgram_to_bundles(
-        tgram, myafq.bundle_dict["01"], myafq.img["01"])
+    img = myafq.img["01"]
+    tgram = load_tractogram(myafq.clean_bundles["01"], img)
+    bundles = aus.tgram_to_bundles(tgram, myafq.bundle_dict["01"], img)
     npt.assert_(len(bundles['CST_L']) > 0)
 
 
 @pytest.mark.nightly_reco
-def test_AFQ_reco():
+def test_AFQ_reco(hardi):
     """
     Test if API can run segmentation with recobundles
     """
-    _, bids_path, _ = get_temp_hardi()
-    myafq = GroupAFQ(
+    _, bids_path, _ = hardi
+    myafq = _mk_afq(
         bids_path=bids_path,
         preproc_pipeline='vistasoft',
         viz_backend_spec="plotly",
@@ -481,66 +584,60 @@ def test_AFQ_reco():
             'seg_algo': 'reco',
             'rng': 42})
 
-    tgram = load_tractogram(myafq.clean_bundles["01"], myafq.img["01"])
-    bundles = aus.tgram_to_bundles(
-        tgram, myafq.bundle_dict["01"], myafq.img["01"])
+    img = myafq.img["01"]
+    tgram = load_tractogram(myafq.clean_bundles["01"], img)
+    bundles = aus.tgram_to_bundles(tgram, myafq.bundle_dict["01"], img)
     npt.assert_(len(bundles['CCMid']) > 0)
     myafq.export_all()
 
 
 @pytest.mark.nightly_custom
-def test_AFQ_reco80():
+def test_AFQ_reco80(hardi):
     """
     Test API segmentation with the 80-bundle atlas
     """
-    tmpdir, bids_path, _ = get_temp_hardi()
-    config_file = op.join(tmpdir.name, "afq_config.toml")
-    completed_process = subprocess.run(
-        f"pyAFQ -g {config_file}",
-        shell=True, capture_output=True)
-    if completed_process.returncode != 0:
-        print(completed_process.stdout)
-    print(completed_process.stderr)
+    tmpdir, bids_path, _ = hardi
+    config_file = op.join(tmpdir, "afq_config.toml")
 
-    with open(config_file, 'a') as ff:
-        ff.write((
-            f"\nbids_path = {bids_path}\n"
-            "preproc_pipeline = 'vistasoft'\n"
-            "segmentation_params = \"{'seg_algo': 'reco80', 'rng': 42}\""))
-
-    cmd = "pyAFQ -v -c export_clean_bundles" + config_file
-    completed_process = subprocess.run(
-        cmd, shell=True, capture_output=True)
-    if completed_process.returncode != 0:
-        print(completed_process.stdout)
-    print(completed_process.stderr)
+    # Run the CLI in this process, to avoid starting a new interpreter
+    arg_dict = afb.func_dict_to_arg_dict()
+    arg_dict['BIDS_PARAMS']['bids_path']['default'] = bids_path
+    arg_dict['BIDS_PARAMS']['preproc_pipeline']['default'] = 'vistasoft'
+    arg_dict['SEGMENTATION_PARAMS']['seg_algo']['default'] = 'reco80'
+    arg_dict['SEGMENTATION_PARAMS']['rng']['default'] = 42
+    afb.generate_config(config_file, arg_dict, False)
+    afb.parse_config_run_afq(
+        config_file, arg_dict, to_call="export_clean_bundles")
 
-    myafq = GroupAFQ(
+    myafq = _mk_afq(
         bids_path=bids_path,
         preproc_pipeline='vistasoft',
         segmentation_params={
             'seg_algo': 'reco80',
             'rng': 42})
 
-    tgram = load_tractogram(myafq.clean_bundles["01"], myafq.img["01"])
-    bundles = aus.tgram_to_bundles(
-        tgram, myafq.bundle_dict["01"], myafq.img["01"])
+    img = myafq.img["01"]
+    tgram = load_tractogram(myafq.clean_bundles["01"], img)
+    bundles = aus.tgram_to_bundles(tgram, myafq.bundle_dict["01"], img)
     npt.assert_(len(bundles['CCMid']) > 0)
 
 
 @pytest.mark.nightly_pft
-def test_AFQ_pft():
+def test_AFQ_pft(hardi):
     """
     Test pft interface for AFQ
     """
-    _, bids_path, sub_path = get_temp_hardi()
+    _, bids_path, sub_path = hardi
 
     bundle_names = ["SLF", "ARC", "CST", "FP"]
 
     f_pve_csf, f_pve_gm, f_pve_wm = get_fnames('stanford_pve_maps')
-    os.rename(f_pve_wm, op.join(sub_path, "sub-01_ses-01_WMprobseg.nii.gz"))
-    os.rename(f_pve_gm, op.join(sub_path, "sub-01_ses-01_GMprobseg.nii.gz"))
-    os.rename(f_pve_csf, op.join(sub_path, "sub-01_ses-01_CSFprobseg.nii.gz"))
+    _link_or_rename(
+        f_pve_wm, op.join(sub_path, "sub-01_ses-01_WMprobseg.nii.gz"))
+    _link_or_rename(
+        f_pve_gm, op.join(sub_path, "sub-01_ses-01_GMprobseg.nii.gz"))
+    _link_or_rename(
+        f_pve_csf, op.join(sub_path, "sub-01_ses-01_CSFprobseg.nii.gz"))
 
     stop_mask = PFTMask(
         MaskFile(suffix="WMprobseg"),
@@ -548,7 +645,7 @@ def test_AFQ_pft():
         MaskFile(suffix="CSFprobseg"))
 
     with nbtmp.InTemporaryDirectory() as t_output_dir:
-        my_afq = GroupAFQ(
+        my_afq = _mk_afq(
             bids_path,
             preproc_pipeline='vistasoft',
             bundle_info=bundle_names,
@@ -562,26 +659,27 @@ def test_AFQ_pft():
 
 
 @pytest.mark.nightly_custom
-def test_AFQ_custom_subject_reg():
+def test_AFQ_custom_subject_reg(hardi_master, hardi):
     """
     Test custom subject registration using AFQ object
     """
     # make first temproary directory to generate b0
-    _, bids_path, sub_path = get_temp_hardi()
+    tmpdir, bids_path, sub_path = hardi
 
     bundle_names = ["SLF", "ARC", "CST", "FP"]
 
-    b0_file = GroupAFQ(
+    b0_file = _mk_afq(
         bids_path,
         preproc_pipeline='vistasoft',
         bundle_info=bundle_names).b0["01"]
 
     # make a different temporary directly to test this custom file in
-    _, bids_path, sub_path = get_temp_hardi()
+    bids_path, sub_path = copy_hardi(
+        hardi_master, op.join(tmpdir, 'custom'))
 
     os.rename(b0_file, op.join(sub_path, "sub-01_ses-01_customb0.nii.gz"))
 
-    my_afq = GroupAFQ(
+    my_afq = _mk_afq(
         bids_path,
         preproc_pipeline='vistasoft',
         bundle_info=bundle_names,
@@ -595,12 +693,12 @@ def test_AFQ_custom_subject_reg():
 
 # Requires large download
 @pytest.mark.nightly
-def test_AFQ_FA():
+def test_AFQ_FA(hardi):
     """
     Test if API can run registeration with FA
     """
-    _, bids_path, _ = get_temp_hardi()
-    myafq = GroupAFQ(
+    _, bids_path, _ = hardi
+    myafq = _mk_afq(
         bids_path=bids_path,
         preproc_pipeline='vistasoft',
         reg_template_spec='dti_fa_template',
@@ -609,13 +707,11 @@ def test_AFQ_FA():
 
 
 @pytest.mark.nightly
-def test_DKI_profile():
+def test_DKI_profile(cfin):
     """
     Test using API to profile dki
     """
-    tmpdir = nbtmp.InTemporaryDirectory()
-    afd.organize_cfin_data(path=tmpdir.name)
-    myafq = GroupAFQ(bids_path=op.join(tmpdir.name, 'cfin_multib'),
+    myafq = GroupAFQ(bids_path=cfin,
                     preproc_pipeline='dipy')
     myafq.dki_fa
     myafq.dki_md
@@ -635,9 +731,9 @@ def test_auto_cli():
 
 
 @pytest.mark.skip(reason="causes segmentation fault")
-def test_run_using_auto_cli():
-    tmpdir, bids_path, _ = get_temp_hardi()
-    config_file = op.join(tmpdir.name, 'test.toml')
+def test_run_using_auto_cli(hardi):
+    tmpdir, bids_path, _ = hardi
+    config_file = op.join(tmpdir, 'test.toml')
 
     arg_dict = afb.func_dict_to_arg_dict()
 
@@ -654,12 +750,12 @@ def test_run_using_auto_cli():
     afb.parse_config_run_afq(config_file, arg_dict, False)
 
 
-def test_AFQ_data_waypoint():
+def test_AFQ_data_waypoint(hardi):
     """
     Test with some actual data again, this time for track segmentation
     """
-    tmpdir, bids_path, _ = get_temp_hardi()
-    t1_path = op.join(tmpdir.name, "T1.nii.gz")
+    tmpdir, bids_path, _ = hardi
+    t1_path = op.join(tmpdir, "T1.nii.gz")
     nib.save(
         afd.read_mni_template(mask=True, weight="T1w"),
         t1_path)
@@ -715,10 +811,10 @@ def test_AFQ_data_waypoint():
         'sub-01_ses-01_dwi_prealign_from-DWI_to-MNI_xfm.npy')
     np.save(reg_prealign_file, np.eye(4))
 
-    tgram = load_tractogram(myafq.bundles, myafq.img)
+    img = myafq.img
+    tgram = load_tractogram(myafq.bundles, img)
 
-    bundles = aus.tgram_to_bundles(
-        tgram, myafq.bundle_dict, myafq.img)
+    bundles = aus.tgram_to_bundles(tgram, myafq.bundle_dict, img)
     npt.assert_(len(bundles['CST_L']) > 0)
 
     # Test ROI exporting:
@@ -793,10 +889,12 @@ def test_AFQ_data_waypoint():
         SEGMENTATION_PARAMS=segmentation_params,
         CLEANING_PARAMS=clean_params)
 
-    config_file = op.join(tmpdir.name, "afq_config.toml")
+    config_file = op.join(tmpdir, "afq_config.toml")
     with open(config_file, 'w') as ff:
         toml.dump(config, ff)
 
+    # Run the installed entry point, so that this also checks the
+    # CLI argument parsing and exit status
     cmd = "pyAFQ -v " + config_file
     completed_process = subprocess.run(
         cmd, shell=True, capture_output=True)
@@ -823,10 +921,8 @@ def test_AFQ_data_waypoint():
 
 
 @pytest.mark.nightly_msmt_and_init
-def test_afq_msmt():
-    tmpdir = nbtmp.InTemporaryDirectory()
-    afd.organize_cfin_data(path=tmpdir.name)
-    myafq = GroupAFQ(bids_path=op.join(tmpdir.name, 'cfin_multib'),
+def test_afq_msmt(cfin):
+    myafq = GroupAFQ(bids_path=cfin,
                     preproc_pipeline='dipy',
                     tracking_params={"odf_model": "MSMT"})
     npt.assert_equal(
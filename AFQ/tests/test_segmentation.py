@@ -1,22 +1,30 @@
+import functools
+import json
 import os.path as op
 
 import pytest
 
 import numpy as np
 import numpy.testing as npt
+import pandas as pd
 
 import nibabel as nib
 import dipy.data as dpd
 import dipy.data.fetcher as fetcher
 import dipy.tracking.streamline as dts
 import dipy.tracking.utils as dtu
-from dipy.stats.analysis import afq_profile
+from dipy.stats.analysis import afq_profile, gaussian_weights
 from dipy.io.stateful_tractogram import StatefulTractogram, Space
+from dipy.io.streamline import load_tractogram, save_tractogram
 
 import AFQ.data as afd
 import AFQ.tractography as aft
 import AFQ.segmentation as seg
 import AFQ.models.dti as dti
+import AFQ.utils.streamlines as aus
+from AFQ.tasks.segmentation import (
+    _bundle_profiles, clean_bundles, export_sl_counts, tract_profiles)
+from AFQ.tasks.utils import get_fname
 
 
 dpd.fetch_stanford_hardi()
@@ -274,3 +282,229 @@ def test_segment_sampled_streamlines():
     # than default; given that random sample and given there are only two
     # streamlines less than equal
     npt.assert_(0 <= len(sampled_fiber_groups['CST_R']) <= len(fiber_groups['CST_R']))
+
+
+def _squared_gauss_weights(bundle):
+    weights = gaussian_weights(bundle) ** 2
+    return weights / np.sum(weights, 0)
+
+
+def _power_gauss_weights(bundle, power):
+    weights = gaussian_weights(bundle) ** power
+    return weights / np.sum(weights, 0)
+
+
+def _random_profile_data(rng):
+    # Two scalar volumes and 30 random walk streamlines, in RASMM
+    scalar_arrays = [rng.rand(20, 20, 20), rng.rand(20, 20, 20)]
+    affine = np.diag([2., 2., 2., 1.])
+    affine[:3, 3] = -10
+
+    sls = []
+    for _ in range(30):
+        steps = rng.normal(0, 0.3, (rng.randint(20, 40), 3))
+        sl_vox = np.clip(rng.uniform(4, 15, 3) + np.cumsum(steps, 0), 1, 18)
+        sls.append(nib.affines.apply_affine(affine, sl_vox))
+    return scalar_arrays, affine, dts.Streamlines(sls)
+
+
+@pytest.mark.parametrize(
+    "profile_weights", ["gauss", "median", None, _squared_gauss_weights])
+def test_bundle_profiles(profile_weights):
+    # The batched profiles should match profiling each bundle separately
+    rng = np.random.RandomState(42)
+    scalar_arrays, affine, sls = _random_profile_data(rng)
+    bundle_idx = [np.arange(12), np.arange(12, 30)]
+
+    profiles = _bundle_profiles(
+        scalar_arrays, sls, bundle_idx, affine, profile_weights)
+    npt.assert_equal(profiles.shape, (2, 200))
+
+    for ii, scalar_data in enumerate(scalar_arrays):
+        for b_idx, idx in enumerate(bundle_idx):
+            if profile_weights == "gauss":
+                weights = gaussian_weights
+            elif profile_weights == "median":
+                # the weighting tract_profiles used with afq_profile
+                def weights(bundle):
+                    values = np.array(dts.values_from_volume(
+                        scalar_data,
+                        dts.set_number_of_points(bundle, 100),
+                        affine))
+                    median_weights = np.zeros(values.shape)
+                    for jj, kk in enumerate(
+                            np.argsort(values, axis=0)[len(values) // 2]):
+                        median_weights[kk, jj] = 1
+                    return median_weights
+            else:
+                weights = profile_weights
+            expected = afq_profile(
+                scalar_data, sls[idx], affine, weights=weights)
+            npt.assert_almost_equal(
+                profiles[ii, b_idx * 100:(b_idx + 1) * 100],
+                expected, decimal=5)
+
+
+def test_tract_profiles_partial_weights(tmp_path):
+    # Weights without a __name__ should still be recorded in the metadata
+    rng = np.random.RandomState(42)
+    scalar_arrays, affine, sls = _random_profile_data(rng)
+    scalar_dict = {}
+    for name, scalar_data in zip(["fa", "md"], scalar_arrays):
+        scalar_dict[name] = op.join(tmp_path, f"{name}.nii.gz")
+        nib.save(nib.Nifti1Image(scalar_data, affine), scalar_dict[name])
+    ref_img = nib.load(scalar_dict["fa"])
+
+    clean_bundles_file = op.join(tmp_path, "clean_bundles.trk")
+    save_tractogram(
+        StatefulTractogram(
+            sls, ref_img, Space.RASMM,
+            data_per_streamline={"bundle": np.repeat([1, 2], [12, 18])}),
+        clean_bundles_file, bbox_valid_check=False)
+
+    subses_dict = {
+        "dwi_file": op.join(tmp_path, "sub-01_dwi.nii.gz"),
+        "results_dir": str(tmp_path)}
+    tracking_params = {"odf_model": "DTI", "directions": "det"}
+    segmentation_params = {"seg_algo": "AFQ"}
+    profile_weights = functools.partial(_power_gauss_weights, power=2)
+    profiles_file = tract_profiles(
+        subses_dict=subses_dict,
+        clean_bundles_file=clean_bundles_file,
+        data_imap={"bundle_dict": {"A": {"uid": 1}, "B": {"uid": 2}}},
+        scalar_dict=scalar_dict,
+        dwi_affine=affine,
+        tracking_params=tracking_params,
+        segmentation_params=segmentation_params,
+        profile_weights=profile_weights)["profiles_file"]
+
+    with open(get_fname(
+            subses_dict, "_profiles.json",
+            tracking_params=tracking_params,
+            segmentation_params=segmentation_params)) as ff:
+        meta = json.load(ff)
+    npt.assert_equal(meta["parameters"]["weights"], repr(profile_weights))
+
+    profiles = pd.read_csv(profiles_file)
+    npt.assert_equal(
+        list(profiles["tractID"]), ["A"] * 100 + ["B"] * 100)
+    expected = _bundle_profiles(
+        scalar_arrays, sls, [np.arange(12), np.arange(12, 30)],
+        affine, _squared_gauss_weights)
+    npt.assert_almost_equal(profiles["fa"], expected[0], decimal=5)
+    npt.assert_almost_equal(profiles["md"], expected[1], decimal=5)
+
+
+@pytest.mark.parametrize("parallel_segmentation", [
+    {"engine": "serial"},
+    {"n_jobs": 2, "engine": "joblib", "backend": "threading"},
+    {"n_jobs": 2, "engine": "joblib", "backend": "loky"}])
+def test_clean_bundles_parallel(tmp_path, parallel_segmentation):
+    # Cleaning bundles in parallel should keep the same streamlines as
+    # cleaning each bundle on its own, including for bundles that are too
+    # small to clean and for bundles with no streamlines
+    rng = np.random.RandomState(42)
+    img = nib.Nifti1Image(np.zeros((20, 20, 20)), np.eye(4))
+    dwi_file = op.join(tmp_path, "sub-01_dwi.nii.gz")
+    nib.save(img, dwi_file)
+
+    def bundle_sls(n_sl, n_outliers=0):
+        sls = []
+        for ii in range(n_sl):
+            sl = rng.normal(0, 0.3, (30, 3))
+            sl[:, 0] += np.linspace(2, 17, 30)
+            sl[:, 1:] += 10
+            if ii < n_outliers:
+                sl[10:20, 1] += 6
+            sls.append(sl)
+        return dts.Streamlines(sls)
+
+    bundle_dict = {"A": {"uid": 1}, "B": {"uid": 2}, "C": {"uid": 3}}
+    bundles = {
+        "A": StatefulTractogram(bundle_sls(30, n_outliers=1), img, Space.VOX),
+        "B": StatefulTractogram(bundle_sls(5), img, Space.VOX)}
+    bundles_file = op.join(tmp_path, "bundles.trk")
+    save_tractogram(
+        aus.bundles_to_tgram(bundles, bundle_dict, img),
+        bundles_file, bbox_valid_check=False)
+    bundles_idx = {
+        "A": list(range(100, 130)), "B": [7, 3, 9, 1, 5], "C": []}
+    afd.write_json(
+        op.join(tmp_path, "bundles.json"), dict(idx=bundles_idx))
+
+    subses_dict = {"dwi_file": dwi_file, "results_dir": str(tmp_path)}
+    tracking_params = {"odf_model": "DTI", "directions": "det"}
+    segmentation_params = {
+        "seg_algo": "AFQ", "parallel_segmentation": parallel_segmentation}
+    clean_bundles_file = clean_bundles(
+        subses_dict=subses_dict,
+        bundles_file=bundles_file,
+        data_imap={"bundle_dict": bundle_dict},
+        tracking_params=tracking_params,
+        segmentation_params=segmentation_params,
+        clean_params={"return_idx": True})["clean_bundles_file"]
+
+    with open(get_fname(
+            subses_dict, "-clean_tractography.json",
+            tracking_params=tracking_params,
+            segmentation_params=segmentation_params)) as ff:
+        meta = json.load(ff)
+    clean_sft = load_tractogram(clean_bundles_file, img, Space.VOX)
+    clean_bundle_sfts = aus.tgram_to_bundles(clean_sft, bundle_dict, img)
+
+    sft = load_tractogram(bundles_file, img, Space.VOX)
+    for b, this_sft in aus.tgram_to_bundles(sft, bundle_dict, img).items():
+        _, expected_idx = seg.clean_bundle(this_sft, return_idx=True)
+        npt.assert_equal(
+            meta["idx"][b],
+            np.array(bundles_idx[b])[expected_idx].tolist())
+        npt.assert_almost_equal(
+            clean_bundle_sfts[b].streamlines.get_data(),
+            this_sft.streamlines[expected_idx].get_data())
+    npt.assert_(len(meta["idx"]["A"]) < 30)
+    npt.assert_equal(meta["idx"]["B"], bundles_idx["B"])
+    npt.assert_equal(meta["idx"]["C"], [])
+
+
+def test_export_sl_counts(tmp_path):
+    # Counts read lazily from the bundle labels should match counting
+    # the streamlines of each bundle after loading the whole tractogram
+    rng = np.random.RandomState(42)
+    img = nib.Nifti1Image(np.zeros((20, 20, 20)), np.eye(4))
+    bundle_dict = {"A": {"uid": 1}, "B": {"uid": 2}, "C": {"uid": 3}}
+
+    bundles_files = {}
+    for name, n_sls in [("bundles", [6, 4]), ("clean_bundles", [5, 0])]:
+        bundles = {
+            b: StatefulTractogram(
+                [rng.uniform(2, 17, (10, 3)) for _ in range(n_sl)],
+                img, Space.VOX)
+            for b, n_sl in zip(["A", "B"], n_sls)}
+        bundles_files[name] = op.join(tmp_path, f"{name}.trk")
+        save_tractogram(
+            aus.bundles_to_tgram(bundles, bundle_dict, img),
+            bundles_files[name], bbox_valid_check=False)
+
+    subses_dict = {
+        "dwi_file": op.join(tmp_path, "sub-01_dwi.nii.gz"),
+        "results_dir": str(tmp_path)}
+    sl_counts_file = export_sl_counts(
+        subses_dict=subses_dict,
+        data_imap={"bundle_dict": bundle_dict},
+        clean_bundles_file=bundles_files["clean_bundles"],
+        bundles_file=bundles_files["bundles"],
+        tracking_params={"odf_model": "DTI", "directions": "det"},
+        segmentation_params={"seg_algo": "AFQ"})["sl_counts_file"]
+    counts = pd.read_csv(sl_counts_file, index_col=0)
+    npt.assert_equal(list(counts.index), ["A", "B", "C", "whole_brain"])
+
+    for name, column in [
+            ("bundles", "n_streamlines"),
+            ("clean_bundles", "n_streamlines_clean")]:
+        sft = load_tractogram(bundles_files[name], img, Space.VOX)
+        for b, this_sft in aus.tgram_to_bundles(
+                sft, bundle_dict, img).items():
+            npt.assert_equal(counts[column][b], len(this_sft))
+        npt.assert_equal(counts[column]["whole_brain"], len(sft))
+    npt.assert_equal(list(counts["n_streamlines"]), [6, 4, 0, 10])
+    npt.assert_equal(list(counts["n_streamlines_clean"]), [5, 0, 0, 5])
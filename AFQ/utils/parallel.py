@@ -86,3 +86,30 @@ def parfor(func, in_list, out_shape=None, n_jobs=-1, engine="joblib",
         return np.array(results).reshape(out_shape)
     else:
         return results
+
+
+def cleanup_loky(parallel_params, logger=None):
+    """
+    Shut down joblib's reusable loky executor, if it was used
+
+    Parameters
+    ----------
+    parallel_params : dict
+        The keyword arguments that were passed to `parfor`.
+    logger : logging.Logger, optional
+        Logger to report the clean up to.
+        Default: None
+
+    Notes
+    -----
+    See https://github.com/joblib/joblib/issues/945
+    """
+    if (
+            parallel_params.get("engine", "joblib") != "serial"
+            and parallel_params.get("backend", None) == "loky"):
+        from joblib.externals.loky import get_reusable_executor
+        if logger is not None:
+            logger.info("Cleaning up Loky...")
+        get_reusable_executor().shutdown(wait=True)
+        if logger is not None:
+            logger.info("Loky Cleaned up")
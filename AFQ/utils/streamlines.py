@@ -1,3 +1,5 @@
+from itertools import chain
+
 import numpy as np
 import nibabel as nib
 from dipy.io.stateful_tractogram import StatefulTractogram, Space
@@ -36,20 +38,45 @@ def bundles_to_tgram(bundles, bundle_dict, reference):
         value dictionary, there must be one `uid` key whose value is a
         unique integer for that bundle.
     reference : Nifti
-        The affine_to_rasmm input to `nib.streamlines.Tractogram`
+        The reference for the output StatefulTractogram.
     """
-    tgram = nib.streamlines.Tractogram([], {'bundle': []})
+    streamlines = []
+    uids = []
     for b in bundles:
         this_sl = bundles[b].streamlines
-        this_tgram = nib.streamlines.Tractogram(
-            this_sl,
-            data_per_streamline={
-                'bundle': (len(this_sl)
-                           * [bundle_dict[b]['uid']])},
-                affine_to_rasmm=reference.affine)
-        tgram = add_bundles(tgram, this_tgram)
-    return StatefulTractogram(tgram.streamlines, reference, Space.VOX,
-                              data_per_streamline=tgram.data_per_streamline)
+        streamlines.append(this_sl)
+        uids.append(np.full(len(this_sl), bundle_dict[b]['uid']))
+    # Build the combined streamlines in one pass, instead of
+    # concatenating each bundle onto everything before it
+    streamlines = nib.streamlines.ArraySequence(
+        chain.from_iterable(streamlines))
+    if len(uids) > 0:
+        uids = np.concatenate(uids)
+    return StatefulTractogram(streamlines, reference, Space.VOX,
+                              data_per_streamline={'bundle': uids})
+
+
+def bundle_idx_by_uid(bundle_labels):
+    """
+    Group streamline indices by bundle uid in a single pass.
+
+    Parameters
+    ----------
+    bundle_labels : array
+        The `bundle` data_per_streamline of a tractogram, holding one
+        bundle uid per streamline.
+
+    Returns
+    -------
+    dict
+        Each key is a uid found in `bundle_labels` and each value is an
+        array of the indices of streamlines with that uid, in ascending
+        order.
+    """
+    labels = np.asarray(bundle_labels).ravel()
+    order = np.argsort(labels, kind='stable')
+    uids, starts = np.unique(labels[order], return_index=True)
+    return dict(zip(uids, np.split(order, starts[1:])))
 
 
 def tgram_to_bundles(tgram, bundle_dict, reference):
@@ -67,10 +94,11 @@ def tgram_to_bundles(tgram, bundle_dict, reference):
         `uid` key that is a unique integer for that bundle.
     """
     bundles = {}
+    uid_to_idx = bundle_idx_by_uid(tgram.data_per_streamline['bundle'])
     for bb in bundle_dict.keys():
         if not bb == 'whole_brain':
             uid = bundle_dict[bb]['uid']
-            idx = np.where(tgram.data_per_streamline['bundle'] == uid)[0]
+            idx = uid_to_idx.get(uid, np.array([], dtype=int))
             bundles[bb] = StatefulTractogram(
                 tgram.streamlines[idx].copy(), reference, Space.VOX)
     return bundles
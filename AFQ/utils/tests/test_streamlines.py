@@ -45,6 +45,18 @@ def test_bundles_to_tgram():
                 npt.assert_equal(sl1, sl2)
 
 
+def test_bundle_idx_by_uid():
+    labels = np.array([[2], [1], [2], [3], [1], [2]])
+    uid_to_idx = aus.bundle_idx_by_uid(labels)
+    npt.assert_equal(sorted(uid_to_idx.keys()), [1, 2, 3])
+    npt.assert_array_equal(uid_to_idx[1], [1, 4])
+    npt.assert_array_equal(uid_to_idx[2], [0, 2, 5])
+    npt.assert_array_equal(uid_to_idx[3], [3])
+    for uid in uid_to_idx:
+        npt.assert_array_equal(
+            uid_to_idx[uid], np.where(labels.ravel() == uid)[0])
+
+
 def test_split_streamline():
     streamlines = dts.Streamlines([np.array([[1.,2.,3.],
                                     [4.,5.,6.]]),
@@ -42,7 +42,8 @@ def transform_inverse_roi(roi, mapping, bundle_name="ROI"):
     if isinstance(roi, str):
         roi = nib.load(roi)
     if isinstance(roi, nib.Nifti1Image):
-        roi = roi.get_fdata()
+        # dipy warps in float32, so there is no need for float64 here
+        roi = roi.get_fdata(dtype=np.float32)
 
     _roi = mapping.transform_inverse(roi, interpolation='linear')
 